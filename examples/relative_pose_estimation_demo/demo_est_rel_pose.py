@@ -48,8 +48,9 @@ def estimate_relative_pose(coarse_model, fine_model, renderer, sensor_image, sta
 
     # not_POI contains all points except of POI
     coords = coords.reshape(H_obs * W_obs, 2)
-    not_POI = set(tuple(point) for point in coords) - set(tuple(point) for point in POI)
-    not_POI = np.array([list(point) for point in not_POI]).astype(int)
+    POI_mask = np.zeros((H_obs, W_obs), dtype=bool)
+    POI_mask[POI[:,1], POI[:,0]] = True
+    not_POI = coords[~POI_mask.reshape(-1)]
 
 
     # Create pose transformation model
@@ -79,9 +80,8 @@ def estimate_relative_pose(coarse_model, fine_model, renderer, sensor_image, sta
         target_s = torch.Tensor(target_s).to(device)
         pose = cam_transf(start_pose)
 
-        rays_o, rays_d = get_rays(H_obs, W_obs, K, pose)  # (H, W, 3), (H, W, 3)
-        rays_o = rays_o[batch[:, 1], batch[:, 0]]  # (N_rand, 3)
-        rays_d = rays_d[batch[:, 1], batch[:, 0]]
+        # batch holds (x, y) pixels; get_rays expects (row, col)
+        rays_o, rays_d = get_rays(H_obs, W_obs, K, pose, np.stack([batch[:, 1], batch[:, 0]], -1))  # (N_rand, 3), (N_rand, 3)
         batch_rays = torch.stack([rays_o, rays_d], 0)
 
         rgb, _, _, _ = renderer.render_from_rays(H_obs,
@@ -159,8 +159,7 @@ def find_POI(img_rgb, DEBUG=False): # img - RGB image in range 0...255
     xy = [keypoint.pt for keypoint in keypoints]
     xy = np.array(xy).astype(int)
     # Remove duplicate points
-    xy_set = set(tuple(point) for point in xy)
-    xy = np.array([list(point) for point in xy_set]).astype(int)
+    xy = np.unique(xy, axis=0)
     return xy # pixel coordinates
 
 rot_psi = lambda phi: np.array([
@@ -189,13 +188,12 @@ trans_t = lambda t: np.array([
 
 def vec2ss_matrix(vector):  # vector to skewsym. matrix
 
-    ss_matrix = torch.zeros((3,3))
-    ss_matrix[0, 1] = -vector[2]
-    ss_matrix[0, 2] = vector[1]
-    ss_matrix[1, 0] = vector[2]
-    ss_matrix[1, 2] = -vector[0]
-    ss_matrix[2, 0] = -vector[1]
-    ss_matrix[2, 1] = vector[0]
+    # stack instead of index writes keeps it a single differentiable expression
+    zero = torch.zeros_like(vector[0])
+    ss_matrix = torch.stack([
+        torch.stack([zero, -vector[2], vector[1]]),
+        torch.stack([vector[2], zero, -vector[0]]),
+        torch.stack([-vector[1], vector[0], zero])])
 
     return ss_matrix
 
@@ -210,9 +208,10 @@ class camera_transf(nn.Module):
     def forward(self, x):
         exp_i = torch.zeros((4,4))
         w_skewsym = vec2ss_matrix(self.w)
-        v_skewsym = vec2ss_matrix(self.v)
-        exp_i[:3, :3] = torch.eye(3) + torch.sin(self.theta) * w_skewsym + (1 - torch.cos(self.theta)) * torch.matmul(w_skewsym, w_skewsym)
-        exp_i[:3, 3] = torch.matmul(torch.eye(3) * self.theta + (1 - torch.cos(self.theta)) * w_skewsym + (self.theta - torch.sin(self.theta)) * torch.matmul(w_skewsym, w_skewsym), self.v)
+        # The squared skew matrix is shared by the rotation and the left Jacobian
+        w_skewsym_sq = torch.matmul(w_skewsym, w_skewsym)
+        exp_i[:3, :3] = torch.eye(3) + torch.sin(self.theta) * w_skewsym + (1 - torch.cos(self.theta)) * w_skewsym_sq
+        exp_i[:3, 3] = torch.matmul(torch.eye(3) * self.theta + (1 - torch.cos(self.theta)) * w_skewsym + (self.theta - torch.sin(self.theta)) * w_skewsym_sq, self.v)
         exp_i[3, 3] = 1.
         T_i = torch.matmul(exp_i, x)
         return T_i
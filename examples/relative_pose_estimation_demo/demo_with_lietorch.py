@@ -48,8 +48,9 @@ def estimate_relative_pose(coarse_model, fine_model, renderer, sensor_image, sta
 
     # not_POI contains all points except of POI
     coords = coords.reshape(H_obs * W_obs, 2)
-    not_POI = set(tuple(point) for point in coords) - set(tuple(point) for point in POI)
-    not_POI = np.array([list(point) for point in not_POI]).astype(int)
+    POI_mask = np.zeros((H_obs, W_obs), dtype=bool)
+    POI_mask[POI[:,1], POI[:,0]] = True
+    not_POI = coords[~POI_mask.reshape(-1)]
 
 
     # Create pose transformation model
@@ -80,9 +81,8 @@ def estimate_relative_pose(coarse_model, fine_model, renderer, sensor_image, sta
         target_s = obs_img_noised[batch[:, 1], batch[:, 0]]
         target_s = torch.Tensor(target_s).to(device)
 
-        rays_o, rays_d = get_rays(H_obs, W_obs, K, starting_pose.retr().matrix())  # (H, W, 3), (H, W, 3)
-        rays_o = rays_o[batch[:, 1], batch[:, 0]]  # (N_rand, 3)
-        rays_d = rays_d[batch[:, 1], batch[:, 0]]
+        # batch holds (x, y) pixels; get_rays expects (row, col)
+        rays_o, rays_d = get_rays(H_obs, W_obs, K, starting_pose.retr().matrix(), np.stack([batch[:, 1], batch[:, 0]], -1))  # (N_rand, 3), (N_rand, 3)
         batch_rays = torch.stack([rays_o, rays_d], 0)
 
         rgb, _, _, _ = renderer.render_from_rays(H_obs,
@@ -167,8 +167,7 @@ def find_POI(img_rgb, DEBUG=False): # img - RGB image in range 0...255
     xy = [keypoint.pt for keypoint in keypoints]
     xy = np.array(xy).astype(int)
     # Remove duplicate points
-    xy_set = set(tuple(point) for point in xy)
-    xy = np.array([list(point) for point in xy_set]).astype(int)
+    xy = np.unique(xy, axis=0)
     return xy # pixel coordinates
 
 rot_psi = lambda phi: np.array([
@@ -44,11 +44,18 @@ def run():
         # Create optimizer for trainable params.
         optimizer = utils.get_optimizer(coarse_model, fine_model, args)
 
+        # Gradient scaler for fp16 mixed precision, a no-op unless --amp is set on GPU
+        use_amp = args.amp and device.type == 'cuda'
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
         # Load any available checkpoints.
-        start = utils.load_checkpoint(coarse_model, fine_model, optimizer, args, b_load_ckpnt_as_trainable=True)
+        start = utils.load_checkpoint(coarse_model, fine_model, optimizer, args, b_load_ckpnt_as_trainable=True, scaler=scaler)
 
         renderer = utils.get_renderer(args, bds_dict)
 
+        if args.compile:
+            utils.compile_nerf_models(coarse_model, fine_model)
+
         global_step = start
 
         # Move testing data to GPU
@@ -56,6 +63,7 @@ def run():
 
         # Batch the training data
         images, poses, rays_rgb, use_batching, N_rand, i_batch = utils.batch_training_data(args, poses, hwf, K, images, i_train)
+        ray_perm = None
 
         N_iters = 200000 + 1
         print('Begin')
@@ -69,20 +77,21 @@ def run():
 
             # Randomly select a batch of rays across images, or randomly sample from a single image per iteration
             # determined by boolean use_batching
-            batch_rays, target_s, rays_rgb, i_batch = utils.sample_random_ray_batch(args, images, poses,
+            batch_rays, target_s, ray_perm, i_batch = utils.sample_random_ray_batch(args, images, poses,
                                                     rays_rgb, N_rand, use_batching, i_batch, i_train,
-                                                    hwf, K, start, i)
+                                                    hwf, K, start, i, ray_perm=ray_perm)
 
             #####  Core optimization loop  #####
-            rgb, _, _, extras = renderer.render_from_rays(H,
-                                                          W,
-                                                          K,
-                                                          chunk=args.chunk,
-                                                          rays=batch_rays,
-                                                          coarse_model=coarse_model,
-                                                          fine_model=fine_model,
-                                                          retraw=True)
-            optimizer.zero_grad()
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                rgb, _, _, extras = renderer.render_from_rays(H,
+                                                              W,
+                                                              K,
+                                                              chunk=args.chunk,
+                                                              rays=batch_rays,
+                                                              coarse_model=coarse_model,
+                                                              fine_model=fine_model,
+                                                              retraw=True)
+            optimizer.zero_grad(set_to_none=True)
             #Mean squared error between rendered ray RGB vs. Ground Truth RGB using the fine model
             img_loss = utils.img2mse(rgb, target_s)
             trans = extras['raw'][...,-1]
@@ -100,8 +109,9 @@ def run():
 
             # TODO(pculbert, chengine): Debug optimization; performance does not match
             # original implementation.
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             # NOTE: IMPORTANT!
             ###   update learning rate   ###
@@ -116,7 +126,7 @@ def run():
             # Logging
             # Periodically saves weights
             if i%args.i_weights==0:
-                utils.save_checkpoints(args, coarse_model, fine_model, optimizer, global_step, i)
+                utils.save_checkpoints(args, coarse_model, fine_model, optimizer, global_step, i, scaler=scaler)
             '''
             # Constructs a panoramic video of a camera within the NeRF scene
             if i%args.i_video==0 and i > 0:
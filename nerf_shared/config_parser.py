@@ -39,6 +39,10 @@ def config_parser():
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None, 
                         help='specific weights npy file to reload for coarse network')
+    parser.add_argument("--compile", action='store_true', 
+                        help='compile the NeRF models with torch.compile (requires torch>=2.0)')
+    parser.add_argument("--amp", action='store_true', 
+                        help='train with fp16 mixed precision (CUDA only)')
 
     # rendering options
     parser.add_argument("--N_samples", type=int, default=64, 
@@ -14,11 +14,9 @@ class Embedder:
         self.create_embedding_fn()
 
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs['input_dims']
         out_dim = 0
         if self.kwargs['include_input']:
-            embed_fns.append(lambda x : x)
             out_dim += d
 
         max_freq = self.kwargs['max_freq_log2']
@@ -29,16 +27,24 @@ class Embedder:
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
 
-        for freq in freq_bands:
-            for p_fn in self.kwargs['periodic_fns']:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq : p_fn(x * freq))
-                out_dim += d
-
-        self.embed_fns = embed_fns
-        self.out_dim = out_dim
+        # Copies of the frequency bands per device, filled lazily by embed()
+        self.freq_bands = {freq_bands.device: freq_bands}
+        self.periodic_dim = N_freqs * len(self.kwargs['periodic_fns']) * d
+        self.out_dim = out_dim + self.periodic_dim
 
     def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        freq_bands = self.freq_bands.get(inputs.device)
+        if freq_bands is None:
+            freq_bands = next(iter(self.freq_bands.values())).to(inputs.device)
+            self.freq_bands[inputs.device] = freq_bands
+
+        # Scale by all frequencies at once, [..., N_freqs, d]
+        scaled = inputs[..., None, :] * freq_bands[:, None]
+        periodic = torch.stack([p_fn(scaled) for p_fn in self.kwargs['periodic_fns']], -2)
+        periodic = torch.reshape(periodic, list(inputs.shape[:-1]) + [self.periodic_dim])
+        if self.kwargs['include_input']:
+            return torch.cat([inputs, periodic], -1)
+        return periodic
 
 def get_embedder(multires, i=0):
     if i == -1:
@@ -98,9 +104,10 @@ class NeRF(nn.Module):
         embedded = self.embed_fn(inputs_flat)
 
         if viewdirs is not None:
-            input_dirs = viewdirs[:,None].expand(inputs.shape)
-            input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-            embedded_dirs = self.embeddirs_fn(input_dirs_flat)
+            # Embed each ray direction once, then share it across all samples along that ray
+            embedded_dirs = self.embeddirs_fn(viewdirs)
+            embedded_dirs = embedded_dirs[:,None].expand(list(inputs.shape[:-1]) + [embedded_dirs.shape[-1]])
+            embedded_dirs = torch.reshape(embedded_dirs, [-1, embedded_dirs.shape[-1]])
             embedded = torch.cat([embedded, embedded_dirs], -1)
 
         outputs_flat = torch.cat([self.MLP(embedded[i:i+netchunk]) for i in range(0, embedded.shape[0], netchunk)], 0)
@@ -138,9 +145,11 @@ class NeRF(nn.Module):
                     points: torchtyping.TensorType["dims":..., 3],
                     chunk=1024*64) -> torchtyping.TensorType["dims":...]:
 
-        view_dir = torch.ones_like(points[..., 0, :])
-        output = self.forward(points, view_dir, chunk)
-        return output[..., -1]
+        # Query all points as one flat batch
+        points_flat = torch.reshape(points, [-1, 1, 3])
+        view_dir = torch.ones_like(points_flat[:, 0]) if self.use_viewdirs else None
+        output = self.forward(points_flat, view_dir, chunk)
+        return torch.reshape(output[..., -1], points.shape[:-1])
 
     '''
     def load_weights_from_keras(self, weights):
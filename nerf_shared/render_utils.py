@@ -10,6 +10,11 @@ from nerf_shared import utils
 
 DEBUG = False
 
+# Scripted so the relu/mul/exp/sub chain can be fused into a single kernel
+@torch.jit.script
+def raw2alpha(raw, dists):
+    return 1.-torch.exp(-F.relu(raw)*dists)
+
 class Renderer(torch.nn.Module):
     def __init__(self, perturb=True, N_importance=128, N_samples=64, use_viewdirs=True,
                  white_bkgd=True, raw_noise_std=0.0, ndc=False, lindisp=False,
@@ -29,6 +34,9 @@ class Renderer(torch.nn.Module):
         self.near = near
         self.far = far
 
+        # Sample positions along each ray, shared by every render_rays call
+        self.register_buffer('t_vals', torch.linspace(0., 1., steps=self.N_samples), persistent=False)
+
         print(self.__dict__)
 
     def render_from_pose(self, H, W, K, chunk, c2w, coarse_model,
@@ -102,7 +110,7 @@ class Renderer(torch.nn.Module):
         bounds = torch.reshape(ray_batch[...,6:8], [-1,1,2])
         near, far = bounds[...,0], bounds[...,1] # [-1,1]
 
-        t_vals = torch.linspace(0., 1., steps=self.N_samples)
+        t_vals = self.t_vals
         if not self.lindisp:
             z_vals = near * (1.-t_vals) + far * (t_vals)
         else:
@@ -167,9 +175,11 @@ class Renderer(torch.nn.Module):
             ret['acc0'] = acc_map_0
             ret['z_std'] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
 
-        for k in ret:
-            if (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()) and DEBUG:
-                print(f"! [Numerical Error] {k} contains nan or inf.")
+        # .any() syncs with the device, so only scan when debugging
+        if DEBUG:
+            for k in ret:
+                if torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any():
+                    print(f"! [Numerical Error] {k} contains nan or inf.")
 
         return ret
 
@@ -220,10 +230,11 @@ class Renderer(torch.nn.Module):
         rays_o = torch.reshape(rays_o, [-1,3]).float()
         rays_d = torch.reshape(rays_d, [-1,3]).float()
 
-        near, far = self.near * torch.ones_like(rays_d[...,:1]), self.far * torch.ones_like(rays_d[...,:1])
-        rays = torch.cat([rays_o, rays_d, near, far], -1)
+        near, far = torch.full_like(rays_d[...,:1], self.near), torch.full_like(rays_d[...,:1], self.far)
+        ray_fields = [rays_o, rays_d, near, far]
         if self.use_viewdirs:
-            rays = torch.cat([rays, viewdirs], -1)
+            ray_fields.append(viewdirs)
+        rays = torch.cat(ray_fields, -1)
 
         # Render and reshape
         #print(rays.shape)
@@ -251,12 +262,10 @@ class Renderer(torch.nn.Module):
             weights: [num_rays, num_samples]. Weights assigned to each sampled color.
             depth_map: [num_rays]. Estimated distance to object.
         """
-        raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-act_fn(raw)*dists)
-
         dists = z_vals[...,1:] - z_vals[...,:-1]
-        dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
+        dists = torch.cat([dists, torch.full_like(dists[...,:1], 1e10)], -1)  # [N_rays, N_samples]
 
-        dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+        dists = dists * torch.norm(rays_d, dim=-1, keepdim=True)
 
         rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
         noise = 0.
@@ -274,15 +283,15 @@ class Renderer(torch.nn.Module):
         #print('Alpha', alpha.shape)
 
         # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
-        weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
+        weights = alpha * torch.cumprod(torch.cat([torch.ones_like(alpha[...,:1]), 1.-alpha + 1e-10], -1), -1)[:, :-1]
 
         #print('Weights', weights.shape)
 
         rgb_map = torch.sum(weights[...,None] * rgb, -2)  # [N_rays, 3]
 
         depth_map = torch.sum(weights * z_vals, -1)
-        disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / torch.sum(weights, -1))
         acc_map = torch.sum(weights, -1)
+        disp_map = 1./torch.clamp(depth_map / acc_map, min=1e-10)
 
         if self.white_bkgd:
             rgb_map = rgb_map + (1.-acc_map[...,None])
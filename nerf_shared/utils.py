@@ -1,4 +1,6 @@
+import functools
 import imageio
+import inspect
 import numpy as np
 import os
 import time
@@ -24,17 +26,25 @@ DEBUG = False
 img2mse = lambda x, y : torch.mean((x - y) ** 2)
 
 #Converts mean-squared error to Peak-Signal-Noise-Ratio (PSNR)
-mse2psnr = lambda x : -10. * torch.log(x) / torch.log(torch.Tensor([10.]))
+mse2psnr = lambda x : -10. * torch.log10(x)
 
 #Converts an image's pixels values from [0, 1] to [0, 255]
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
 
 #### Ray-tracing helpers ###
-def get_rays(H, W, K, c2w):
-    i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(0, H-1, H))  # pytorch's meshgrid has indexing='ij'
+# Camera-frame ray directions, cached per camera and device
+@functools.lru_cache(maxsize=8)
+def get_camera_dirs(H, W, fx, fy, cx, cy, device):
+    i, j = torch.meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))  # pytorch's meshgrid has indexing='ij'
     i = i.t()
     j = j.t()
-    dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
+    return torch.stack([(i-cx)/fx, -(j-cy)/fy, -torch.ones_like(i)], -1)
+
+def get_rays(H, W, K, c2w, coords=None):
+    dirs = get_camera_dirs(int(H), int(W), float(K[0][0]), float(K[1][1]), float(K[0][2]), float(K[1][2]), c2w.device)
+    if coords is not None:
+        # Only transform the requested (row, col) pixels
+        dirs = dirs[coords[:, 0], coords[:, 1]]
     # Rotate ray directions from camera frame to the world frame
     rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
     # Translate camera frame's origin to the world frame. It is the origin of all rays.
@@ -99,8 +109,8 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     # Invert CDF
     u = u.contiguous()
     inds = torch.searchsorted(cdf, u, right=True)
-    below = torch.max(torch.zeros_like(inds-1), inds-1)
-    above = torch.min((cdf.shape[-1]-1) * torch.ones_like(inds), inds)
+    below = torch.clamp(inds-1, min=0)
+    above = torch.clamp(inds, max=cdf.shape[-1]-1)
     inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
 
     # cdf_g = tf.gather(cdf, inds_g, axis=-1, batch_dims=len(inds_g.shape)-2)
@@ -138,6 +148,17 @@ def create_nerf_models(args):
 
     return coarse_model, fine_model
 
+def compile_nerf_models(coarse_model, fine_model):
+    """Compile each model's forward with torch.compile; state_dict keys are unchanged.
+    """
+    if not hasattr(torch, 'compile'):
+        print('torch.compile requires torch>=2.0, running models uncompiled')
+        return
+
+    for model in [coarse_model, fine_model]:
+        if model is not None:
+            model.forward = torch.compile(model.forward)
+
 def get_renderer(args, bds_dict):
 
     render_kwargs = {
@@ -166,13 +187,16 @@ def get_optimizer(coarse_model, fine_model, args):
     if fine_model is not None:
         grad_vars += list(fine_model.parameters())
 
-    # Create optimizer
-    optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
+    # Create optimizer, using the fused Adam step on GPU where available
+    adam_kwargs = {}
+    if device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.Adam).parameters:
+        adam_kwargs['fused'] = True
+    optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999), **adam_kwargs)
 
     return optimizer
 
 def load_checkpoint(coarse_model, fine_model, optimizer, args,
-                    b_load_ckpnt_as_trainable=False, checkpoint_index=None):
+                    b_load_ckpnt_as_trainable=False, checkpoint_index=None, scaler=None):
     """
     b_load_ckpnt_as_trainable - controls if we load file w/ grad set to true or false. If model
         will continue to be trained this must be True, otherwise set to False to save memory
@@ -199,7 +223,18 @@ def load_checkpoint(coarse_model, fine_model, optimizer, args,
         ckpt = torch.load(ckpt_path, map_location=device)
 
         start = ckpt['global_step']
+        fused = optimizer.defaults.get('fused', False)
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+        # load_state_dict replaces param_groups, so restore this run's fused setting
+        for param_group in optimizer.param_groups:
+            param_group['fused'] = fused
+        if fused:
+            for param, state in optimizer.state.items():
+                if 'step' in state:
+                    state['step'] = torch.as_tensor(state['step'], dtype=torch.float32, device=param.device)
+
+        if scaler is not None and scaler.is_enabled() and 'scaler_state_dict' in ckpt:
+            scaler.load_state_dict(ckpt['scaler_state_dict'])
 
         # Load model
         coarse_model.load_state_dict(ckpt['coarse_model_state_dict'], strict=False)
@@ -369,19 +404,17 @@ def batch_training_data(args, poses, hwf, K, images, i_train):
         rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
         print('done, concats')
         rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
-        rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
-        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
-        rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
+        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 1) # train images only, [ro+rd+rgb, N-1, H, W, 3]
+        rays_rgb = np.reshape(rays_rgb, [3,-1,3]) # [ro+rd+rgb, (N-1)*H*W, 3]
         rays_rgb = rays_rgb.astype(np.float32)
         print('shuffle rays')
-        np.random.shuffle(rays_rgb)
+        np.random.shuffle(np.swapaxes(rays_rgb, 0, 1)) # shuffles rays in place across all three planes
 
         print('done')
         i_batch = 0
 
     # Move training data to GPU
-    if use_batching:
-        images = torch.Tensor(images).to(device)
+    images = torch.Tensor(images).to(device)
     poses = torch.Tensor(poses).to(device)
     if use_batching:
         rays_rgb = torch.Tensor(rays_rgb).to(device)
@@ -391,68 +424,74 @@ def batch_training_data(args, poses, hwf, K, images, i_train):
 
     return images, poses, rays_rgb, use_batching, N_rand, i_batch
 
-def sample_random_ray_batch(args, images, poses, rays_rgb, N_rand, use_batching, i_batch, i_train, hwf, K, start, i):
+# Flattened (row, col) pixel grid of an image window, cached across iterations
+@functools.lru_cache(maxsize=4)
+def get_pixel_coords(row_start, row_end, col_start, col_end):
+    coords = torch.stack(torch.meshgrid(torch.arange(row_start, row_end), torch.arange(col_start, col_end)), -1)
+    return torch.reshape(coords, [-1,2])
+
+def sample_random_ray_batch(args, images, poses, rays_rgb, N_rand, use_batching, i_batch, i_train, hwf, K, start, i, ray_perm=None):
+    """
+    Returns batch_rays, target_s, ray_perm, i_batch. rays_rgb is never reshuffled in place; after each
+        epoch a new ray_perm index is returned instead, which callers pass back in on the next call.
+    """
     H, W, _ = hwf
 
     # Sample random ray batch
     if use_batching:
         # Random over all images
-        batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1, 3*?]
-        batch = torch.transpose(batch, 0, 1)
+        if ray_perm is None:
+            batch = rays_rgb[:, i_batch:i_batch+N_rand] # [2+1, B, 3*?]
+        else:
+            batch = rays_rgb[:, ray_perm[i_batch:i_batch+N_rand]]
         batch_rays, target_s = batch[:2], batch[2]
 
         i_batch += N_rand
-        if i_batch >= rays_rgb.shape[0]:
+        if i_batch >= rays_rgb.shape[1]:
             print("Shuffle data after an epoch!")
-            rand_idx = torch.randperm(rays_rgb.shape[0])
-            rays_rgb = rays_rgb[rand_idx]
+            # Shuffle an index instead of copying rays_rgb
+            ray_perm = torch.randperm(rays_rgb.shape[1])
             i_batch = 0
 
     else:
         # Random from one image
         img_i = np.random.choice(i_train)
         target = images[img_i]
-        target = torch.Tensor(target).to(device)
         pose = poses[img_i, :3,:4]
 
         if N_rand is not None:
-            rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
             if i < args.precrop_iters:
                 dH = int(H//2 * args.precrop_frac)
                 dW = int(W//2 * args.precrop_frac)
-                coords = torch.stack(
-                    torch.meshgrid(
-                        torch.linspace(H//2 - dH, H//2 + dH - 1, 2*dH),
-                        torch.linspace(W//2 - dW, W//2 + dW - 1, 2*dW)
-                    ), -1)
+                coords = get_pixel_coords(H//2 - dH, H//2 + dH, W//2 - dW, W//2 + dW)
                 if i == start:
                     print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")
             else:
-                coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)  # (H, W, 2)
+                coords = get_pixel_coords(0, H, 0, W)  # (H * W, 2)
 
-            coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
             select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-            select_coords = coords[select_inds].long()  # (N_rand, 2)
-            rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-            rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            select_coords = coords[select_inds]  # (N_rand, 2)
+            rays_o, rays_d = get_rays(H, W, K, pose, select_coords)  # (N_rand, 3), (N_rand, 3)
             batch_rays = torch.stack([rays_o, rays_d], 0)
             target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
 
-    return batch_rays, target_s, rays_rgb, i_batch
+    return batch_rays, target_s, ray_perm, i_batch
 
-def save_checkpoints(args, coarse_model, fine_model, optimizer, global_step, i):
+def save_checkpoints(args, coarse_model, fine_model, optimizer, global_step, i, scaler=None):
     basedir = args.basedir
     expname = args.expname
 
     # Logs chckpoints
     path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
-    torch.save({
+    ckpt = {
         'global_step': global_step,
         'coarse_model_state_dict': coarse_model.state_dict(),
         'fine_model_state_dict': fine_model.state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
-    }, path)
+    }
+    if scaler is not None and scaler.is_enabled():
+        ckpt['scaler_state_dict'] = scaler.state_dict()
+    torch.save(ckpt, path)
     print('Saved checkpoints at', path)
 
 def render_training_video(args, render_poses, hwf, K, render_kwargs_test, i):